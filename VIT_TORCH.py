@@ -4,7 +4,8 @@ from tqdm import tqdm
 
 import torch
 import torch.nn  as nn
-from torch.optim import Adam
+import torch.nn.functional as F
+from torch.optim import AdamW
 from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader
 
@@ -15,20 +16,6 @@ np.random.seed(0)
 torch.manual_seed(0)
 
 
-def patchify(images, n_patches):
-    n, c, h, w = images.shape
-    assert h == w, "Patchify method is impolemented for square images only"
-    
-    patches = torch.zeros(n, n_patches ** 2,h * w // n_patches ** 2)
-    patch_size = h // n_patches
-    
-    for idx, image in enumerate(images):
-        for i in range(n_patches):
-            for j in range(n_patches):
-                patch = image[:,i * patch_size : (i + 1)* patch_size,j * patch_size : (j + 1)*patch_size]
-                patches[idx, i *n_patches + j] = patch.flatten()
-    return patches
-
 class MyMSA(nn.Module):
     def __init__(self,d, n_heads = 2):
         super().__init__()
@@ -38,30 +25,25 @@ class MyMSA(nn.Module):
         assert d % n_heads == 0,f"Can't divide dimension {d} into {n_heads} heads"
         
         d_head = int(d / n_heads)
-        self.q_mappings = nn.ModuleList([nn.Linear(d_head,d_head) for _ in range(self.n_heads)])
-        self.k_mappings = nn.ModuleList([nn.Linear(d_head,d_head) for _ in range(self.n_heads)])
-        self.v_mappings = nn.ModuleList([nn.Linear(d_head,d_head) for _ in range(self.n_heads)])
+        self.qkv = nn.Linear(d, 3 * d)
         self.d_head = d_head
-        self.softmax = nn.Softmax(dim=-1)
+        self.scale = d_head ** -0.5
     
     def forward(self, sequences):
         # Sequences has shape (N, seq_length, token_dim)
-        # We go into shape    (N, seq_length, n_heads, token_dim / n_heads)
-        # And come back to    (N, seq_length, n_heads, token_dim / n_heads)
-        result = []
-        for sequence in sequences:
-            seq_result = []
-            for head in range(self.n_heads):
-                q_mapping = self.q_mappings[head]
-                k_mapping = self.k_mappings[head]
-                v_mapping = self.v_mappings[head]
-                
-                seq = sequence[:,head * self.d_head:(head + 1)*self.d_head]
-                q, k, v = q_mapping(seq), k_mapping(seq), v_mapping(seq)
-                attention = self.softmax(q @ k.T / (self.d_head ** 0.5))
-                seq_result.append(attention @ v)
-            result.append(torch.hstack(seq_result))
-        return torch.cat([torch.unsqueeze(r,dim=0) for r in result])
+        # We go into shape    (N, n_heads, seq_length, token_dim / n_heads)
+        # And come back to    (N, seq_length, token_dim)
+        B, L, D = sequences.shape
+        # Q, K and V for all heads come from one nn.Linear(d, 3 * d)
+        q, k, v = self.qkv(sequences).chunk(3, dim=-1)
+        q = q.reshape(B, L, self.n_heads, self.d_head).transpose(1, 2)
+        k = k.reshape(B, L, self.n_heads, self.d_head).transpose(1, 2)
+        v = v.reshape(B, L, self.n_heads, self.d_head).transpose(1, 2)
+        
+        # Fused softmax(q @ k.T * scale) @ v, never materializes the attention matrix on CUDA
+        out = F.scaled_dot_product_attention(q, k, v, scale=self.scale)
+        out = out.transpose(1, 2).reshape(B, L, D)
+        return out
                 
 class MyVitBlock(nn.Module):
     def __init__(self, hidden_d, n_heads,mlp_ratio=4):
@@ -100,42 +82,37 @@ class Myvit(nn.Module):
         assert chw[2] % n_patches == 0, "Input shape not entirely divisible bt number of patches"
         self.patch_size = (chw[1] / n_patches, chw[2] / n_patches)
         
-        # 1) Linear mapper 매핑용 레이어
-        self.input_d = int(chw[0]* self.patch_size[0] * self.patch_size[1])
-        self.linear_mapper = nn.Linear(self.input_d, self.hidden_d)
+        # 1) Patch embedding 매핑용 레이어
+        # kernel = stride = patch size, equivalent to patchify + linear mapping
+        self.proj = nn.Conv2d(chw[0], self.hidden_d,
+                              kernel_size=int(self.patch_size[0]), stride=int(self.patch_size[0]))
         
         # 2) Learnable classification token 훈련 가능한 분류용 토큰
-        self.class_token = nn.parameter.Parameter(torch.rand(1, self.hidden_d))
+        self.class_token = nn.parameter.Parameter(torch.rand(1, 1, self.hidden_d))
         
-        # 3) Positional embedding
-        self.pos_embed = nn.parameter.Parameter(torch.tensor(
-            get_positional_embeddings(self.n_patches ** 2 + 1,self.hidden_d)))
-        self.pos_embed.requires_grad = False
+        # 3) Positional embedding (fixed, so a buffer rather than a parameter)
+        self.register_buffer("pos_embed", get_positional_embeddings(self.n_patches ** 2 + 1,self.hidden_d))
         
         # 4) Transformer encode blocks
         self.blocks = nn.ModuleList([MyVitBlock(hidden_d,n_heads) for _ in range(n_blocks)])
         
-        # 5) Classification MLPk
-        self.mlp = nn.Sequential(
-            nn.Linear(self.hidden_d, out_d),
-            nn.Softmax(dim=-1)
-        )
+        # 5) Classification MLPk (outputs logits, CrossEntropyLoss applies log-softmax)
+        self.mlp = nn.Linear(self.hidden_d, out_d)
         
     def forward(self, images):
-        # Dividing images into patches 
         n, c, h, w = images.shape
-        patches = patchify(images, self.n_patches)
+        assert h == w, "Patch embedding is implemented for square images only"
         
-        # Running linear layer tokenization
-        # Map the vector corresponding to each patch to the hidden size dimension
-        tokens = self.linear_mapper(patches)
+        # Dividing images into patches and mapping each patch to the hidden size dimension
+        # (N, C, H, W) -> (N, hidden_d, n_patches, n_patches) -> (N, n_patches ** 2, hidden_d)
+        tokens = self.proj(images).flatten(2).transpose(1, 2)
         
         # Adding classification token to the tokens
-        tokens = torch.stack([torch.vstack((self.class_token, tokens[i])) for i in range(len(tokens))])
+        cls = self.class_token.expand(n, -1, -1)
+        tokens = torch.cat([cls, tokens], dim=1)
         
-        # Adding positional embedding
-        pos_embed = self.pos_embed.repeat(n, 1, 1)
-        out = tokens + pos_embed
+        # Adding positional embedding (broadcast over the batch)
+        out = tokens + self.pos_embed
         
         # Transformer Blocks
         for block in self.blocks:
@@ -144,68 +121,127 @@ class Myvit(nn.Module):
         # Getting the classification token only
         out = out[:, 0]
         
-        return self.mlp(out) # Map to output dimension, output category distribution
+        return self.mlp(out) # Map to output dimension, output category logits
     
 def get_positional_embeddings(sequence_legth,d):
-    result = torch.ones(sequence_legth,d)
-    for i in range(sequence_legth):
-        for j in range(d):
-            result[i][j] = np.sin(i/(10000 ** (j / d))) if j % 2 == 0 else np.cos(i / (10000 **((j - 1) / d)))
-    return result          
+    # Even columns j: sin(i / 10000 ** (j / d)), odd columns j: cos(i / 10000 ** ((j - 1) / d))
+    i = torch.arange(sequence_legth).unsqueeze(1)
+    j = torch.arange(d).unsqueeze(0)
+    denom = 10000 ** ((2 * (j // 2)) / d)
+    result = torch.where(j % 2 == 0, torch.sin(i / denom), torch.cos(i / denom))
+    return result.float()
+
+def capture_cuda_graph(model, input_shape, device, n_warmup=3, memory_format=torch.contiguous_format):
+    # Record one forward pass on a static input buffer so it can be replayed with a single launch
+    static_x = torch.zeros(input_shape, device=device).contiguous(memory_format=memory_format)
+    
+    # Warm up on a side stream before capturing
+    s = torch.cuda.Stream()
+    s.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(s):
+        for _ in range(n_warmup):
+            model(static_x)
+    torch.cuda.current_stream().wait_stream(s)
+    
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_y = model(static_x)
+    return graph, static_x, static_y
     
 def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    
     # Loading data
     transfrom = ToTensor()
     
     train_set = MNIST(root='./../datasets',train=True,download=True,transform=transfrom)
     test_set = MNIST(root='./../datasets',train=False,download=True,transform=transfrom)
 
-    train_loader = DataLoader(train_set, shuffle=True, batch_size=128)
-    test_loader = DataLoader(test_set, shuffle=False, batch_size=128)
+    # drop_last keeps every training batch at the same shape, so the compiled graph is never rebuilt
+    train_loader = DataLoader(train_set, shuffle=True, batch_size=128, drop_last=True,
+                              pin_memory=(device.type == "cuda"), num_workers=4, persistent_workers=True,
+                              prefetch_factor=4)
+    test_loader = DataLoader(test_set, shuffle=False, batch_size=128,
+                             pin_memory=(device.type == "cuda"), num_workers=4, persistent_workers=True,
+                             prefetch_factor=4)
 
     # Defining model and training options
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Mixed precision (CUDA only): bf16 on GPUs with native support (Ampere+), otherwise fp16 with loss scaling.
+    # is_bf16_supported() also reports emulated bf16 on older GPUs, so check the compute capability instead
+    use_amp = device.type == "cuda"
+    amp_dtype = torch.float16 if use_amp and torch.cuda.get_device_capability()[0] < 8 else torch.bfloat16
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     
-    model = Myvit((1,28,28),  n_patches=7, n_blocks=2,hidden_d=8,out_d=10).to(device)
+    vit = Myvit((1,28,28),  n_patches=7, n_blocks=2,hidden_d=8,out_d=10).to(device)
+    # NHWC for the patch embedding conv. With single-channel MNIST NCHW and NHWC are the same layout,
+    # so this is a no-op here and only matters for multi-channel input
+    vit = vit.to(memory_format=torch.channels_last)
+    # Inductor fuses the small LayerNorm / Linear / GELU ops and CUDA graphs remove launch overhead
+    model = torch.compile(vit, mode="reduce-overhead", dynamic=False, fullgraph=True)
     N_EPOCHS = 5
     LR = 0.005
     
     # Training loop
-    optimizer = Adam(model.parameters(),lr=LR)
+    optimizer = AdamW(model.parameters(),lr=LR, weight_decay=0.0, fused=(device.type == "cuda"))
     criterion = CrossEntropyLoss()
+    scaler = torch.amp.GradScaler(device.type, enabled=use_amp and amp_dtype == torch.float16)
     for epoch in tqdm(range(N_EPOCHS),desc="Training"):
-        train_loss =0.0
+        # Accumulate on-device and sync once per epoch instead of once per batch
+        loss_sum = torch.zeros((), device=device)
         for batch in tqdm(train_loader,desc=f"Epoch {epoch +1} in training",leave=False):
             x, y = batch
-            x, y = x.to(device), y.to(device)
-            y_hat = model(x)
-            loss = criterion(y_hat,y)
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            x = x.to(memory_format=torch.channels_last)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                y_hat = model(x)
+                loss = criterion(y_hat,y)
             
-            train_loss += loss.detach().cpu().item() / len(train_loader)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            loss_sum += loss.detach()
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        train_loss = (loss_sum / len(train_loader)).item()
         print(f"Epoch {epoch + 1}/{N_EPOCHS} loss : {train_loss:.2f}")
     
     # Test loop
-    with torch.no_grad():
-        correct, total = 0, 0
-        test_loss = 0.0
+    vit.eval()
+    # Compiled without cudagraphs, so its fused kernels can be captured into the manual CUDA graph below
+    eval_model = torch.compile(vit, dynamic=False, fullgraph=True)
+    with torch.inference_mode():
+        # Every full test batch has the same shape, so replay a captured CUDA graph of the compiled model
+        graph = None
+        if device.type == "cuda":
+            graph, static_x, static_y = capture_cuda_graph(eval_model, (test_loader.batch_size, 1, 28, 28), device,
+                                                            memory_format=torch.channels_last)
+        
+        correct_t = torch.zeros((), dtype=torch.long, device=device)
+        loss_sum = torch.zeros((), device=device)
+        total = 0
         for batch in tqdm(test_loader,desc="Testing"):
             x, y = batch
-            x, y = x.to(device), y.to(device)
-            y_hat = model(x)
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            x = x.to(memory_format=torch.channels_last)
+            if len(x) != test_loader.batch_size:
+                # Trailing partial batch runs eagerly rather than recompiling for a new shape
+                y_hat = vit(x)
+            elif graph is not None:
+                static_x.copy_(x)
+                graph.replay()
+                y_hat = static_y.clone()
+            else:
+                y_hat = eval_model(x)
             loss = criterion(y_hat,y)
-            test_loss += loss.detach().cpu().item() / len(test_loader)
+            loss_sum += loss.detach()
             
-            correct += torch.sum(torch.argmax(y_hat,dim=1) == y).detach().cpu().item()
+            correct_t += torch.sum(torch.argmax(y_hat,dim=1) == y)
             total += len(x)
+        test_loss = (loss_sum / len(test_loader)).item()
+        correct = correct_t.item()
         print(f"Test loss : {test_loss:.2f}")
         print(f"Test accuracy: {correct / total * 100:.2f}%")
         
                 
 if __name__ == '__main__':
     main()
-    
-# Test loss : 1.67
-# Test accuracy: 79.28%
@@ -0,0 +1,21 @@
+import torch
+
+from VIT_TORCH import Myvit
+
+# One-off check that the ViT forward traces as a single graph with no breaks,
+# so torch.compile(..., fullgraph=True) in VIT_TORCH.py can fuse the whole forward.
+# Run it by hand after changing the model; it is not part of the training run.
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    vit = Myvit((1,28,28),  n_patches=7, n_blocks=2,hidden_d=8,out_d=10).to(device)
+    sample = torch.zeros(128, 1, 28, 28, device=device).to(memory_format=torch.channels_last)
+
+    explanation = torch._dynamo.explain(vit)(sample)
+    print(explanation)
+    if explanation.graph_count != 1 or explanation.graph_break_count != 0:
+        raise RuntimeError(f"ViT forward has graph breaks: {explanation.break_reasons}")
+
+if __name__ == '__main__':
+    main()